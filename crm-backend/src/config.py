@@ -15,9 +15,20 @@ class Settings(BaseSettings):
     db_database: str = "clonecrm"
     db_tables: str = "branch,customer,lead,invoice,product,productdtl,city,customertype,customertypedtl"
 
+    # Connection pool settings
+    db_pool_size: int = 20
+    db_max_overflow: int = 10
+    db_pool_recycle: int = 1800
+
+    # Async connection pool settings (segment execution)
+    db_async_pool_size: int = 5
+    db_async_max_overflow: int = 5
+
     # OpenAI settings
     openai_api_key: str = ""
     openai_model: str = "gpt-4o-mini"
+    openai_concurrency: int = 8
+    openai_queue_timeout: float = 30.0
 
     # Server settings
     host: str = "0.0.0.0"
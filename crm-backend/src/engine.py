@@ -1,12 +1,20 @@
 """LlamaIndex NLSQLTableQueryEngine implementation for CRM queries."""
 
+import asyncio
 import logging
-from typing import Optional
+import re
+from contextlib import asynccontextmanager
+from functools import cached_property, lru_cache
+from typing import Any, AsyncIterator, Optional
 from urllib.parse import quote_plus
 
+import orjson
 from sqlalchemy import create_engine, text
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
 from llama_index.core import SQLDatabase, PromptTemplate
 from llama_index.core.query_engine import NLSQLTableQueryEngine
+from llama_index.core.retrievers import SQLRetriever
+from llama_index.core.schema import NodeWithScore, QueryType
 from llama_index.llms.openai import OpenAI
 
 from .config import Settings, get_settings
@@ -21,6 +29,15 @@ from .prompts import (
 
 logger = logging.getLogger(__name__)
 
+# Markdown-fenced JSON payload, e.g. ```json {...} ```
+_FENCE_RE = re.compile(r"```(?:json)?\s*(.*?)\s*```", re.DOTALL)
+
+# LLM responses longer than this (in characters) are parsed off the event loop
+_OFFLOAD_PARSE_THRESHOLD = 4096
+
+# Liveness probe statement, built once and reused by every health check
+_HEALTH_STMT = text("SELECT 1")
+
 
 def strip_markdown_sql(sql: str) -> str:
     """
@@ -53,19 +70,80 @@ def strip_markdown_sql(sql: str) -> str:
     return sql
 
 
+def _parse_fenced_json(raw: str) -> Any:
+    """Parse JSON from LLM output, stripping a markdown code fence if present."""
+    match = _FENCE_RE.search(raw)
+    return orjson.loads(match.group(1) if match else raw)
+
+
+@lru_cache(maxsize=4)
+def _get_llm(api_key: str, model: str) -> OpenAI:
+    """Get cached OpenAI LLM shared across engine instances."""
+    return OpenAI(api_key=api_key, model=model, temperature=0)
+
+
+@lru_cache(maxsize=1)
+def _get_text_to_sql_template() -> PromptTemplate:
+    """Get cached text-to-SQL prompt template."""
+    return PromptTemplate(TEXT_TO_SQL_PROMPT)
+
+
+@lru_cache(maxsize=8)
+def _get_segment_sql_template(current_date: str) -> PromptTemplate:
+    """Get cached segment SQL prompt template for the given date."""
+    return PromptTemplate(SEGMENT_SQL_ONLY_PROMPT.replace("{current_date}", current_date))
+
+
+class LLMBusyError(Exception):
+    """Raised when no OpenAI concurrency slot frees up within the queue timeout."""
+
+
+async def _prepend(first: Any, rest: AsyncIterator) -> AsyncIterator:
+    """Yield an already-read first item, then the rest of the stream."""
+    yield first
+    async for item in rest:
+        yield item
+
+
+class _ThreadedSQLRetriever(SQLRetriever):
+    """SQLRetriever whose async path runs the generated SQL in a worker thread."""
+
+    async def aretrieve_with_metadata(
+        self, str_or_query_bundle: QueryType
+    ) -> tuple[list[NodeWithScore], dict]:
+        # The stock async path calls the sync one, running pymysql on the event loop
+        return await asyncio.to_thread(self.retrieve_with_metadata, str_or_query_bundle)
+
+
 class CRMQueryEngine:
     """CRM Query Engine using LlamaIndex NLSQLTableQueryEngine."""
 
     def __init__(self, settings: Optional[Settings] = None):
         self.settings = settings or get_settings()
         self._engine = None
+        self._async_engine: Optional[AsyncEngine] = None
         self._sql_database = None
         self._query_engine = None
         self._segment_query_engine = None
         self._llm = None
+        self._llm_semaphore = asyncio.Semaphore(self.settings.openai_concurrency)
+        self._inflight_queries: dict[str, asyncio.Task] = {}
 
-    def _get_connection_uri(self) -> str:
-        """Build MySQL connection URI."""
+    @asynccontextmanager
+    async def _llm_slot(self):
+        """Hold an OpenAI concurrency slot, waiting at most openai_queue_timeout seconds for it."""
+        try:
+            async with asyncio.timeout(self.settings.openai_queue_timeout):
+                await self._llm_semaphore.acquire()
+        except TimeoutError:
+            raise LLMBusyError("Layanan LLM sedang sibuk, silakan coba lagi") from None
+        try:
+            yield
+        finally:
+            self._llm_semaphore.release()
+
+    def _get_connection_uri(self, driver: str = "pymysql") -> str:
+        """Build MySQL connection URI for the given DBAPI driver."""
         from urllib.parse import quote_plus
 
         user = quote_plus(self.settings.db_user)
@@ -74,35 +152,55 @@ class CRMQueryEngine:
         port = self.settings.db_port
         database = self.settings.db_database
 
-        return f"mysql+pymysql://{user}:{password}@{host}:{port}/{database}"
+        return f"mysql+{driver}://{user}:{password}@{host}:{port}/{database}"
+
+    @cached_property
+    def _tables(self) -> tuple[str, ...]:
+        """Table names parsed from settings."""
+        return tuple(t.strip() for t in self.settings.db_tables.split(","))
 
     def _init_engine(self):
         """Initialize SQLAlchemy engine."""
         if self._engine is None:
             uri = self._get_connection_uri()
             logger.info(f"Connecting to MySQL database at {self.settings.db_host}:{self.settings.db_port}")
-            self._engine = create_engine(uri)
+            self._engine = create_engine(
+                uri,
+                pool_size=self.settings.db_pool_size,
+                max_overflow=self.settings.db_max_overflow,
+                pool_recycle=self.settings.db_pool_recycle,
+                pool_pre_ping=True,
+                pool_use_lifo=True,
+            )
+
+    def _init_async_engine(self):
+        """Initialize async SQLAlchemy engine used for direct SQL execution."""
+        if self._async_engine is None:
+            uri = self._get_connection_uri(driver="asyncmy")
+            self._async_engine = create_async_engine(
+                uri,
+                pool_size=self.settings.db_async_pool_size,
+                max_overflow=self.settings.db_async_max_overflow,
+                pool_recycle=self.settings.db_pool_recycle,
+                pool_pre_ping=True,
+                pool_use_lifo=True,
+            )
 
     def _init_llm(self):
         """Initialize OpenAI LLM."""
         if self._llm is None:
-            self._llm = OpenAI(
-                api_key=self.settings.openai_api_key,
-                model=self.settings.openai_model,
-                temperature=0,
-            )
+            self._llm = _get_llm(self.settings.openai_api_key, self.settings.openai_model)
             logger.info(f"Initialized OpenAI LLM with model: {self.settings.openai_model}")
 
     def _init_sql_database(self):
         """Initialize LlamaIndex SQLDatabase."""
         if self._sql_database is None:
             self._init_engine()
-            tables = [t.strip() for t in self.settings.db_tables.split(",")]
             self._sql_database = SQLDatabase(
                 self._engine,
-                include_tables=tables,
+                include_tables=self._tables,
             )
-            logger.info(f"Initialized SQLDatabase with tables: {tables}")
+            logger.info(f"Initialized SQLDatabase with tables: {self._tables}")
 
     def _init_query_engine(self):
         """Initialize NLSQLTableQueryEngine."""
@@ -110,16 +208,15 @@ class CRMQueryEngine:
             self._init_sql_database()
             self._init_llm()
 
-            tables = [t.strip() for t in self.settings.db_tables.split(",")]
-            text_to_sql_template = PromptTemplate(TEXT_TO_SQL_PROMPT)
-
             self._query_engine = NLSQLTableQueryEngine(
                 sql_database=self._sql_database,
-                tables=tables,
+                tables=self._tables,
                 llm=self._llm,
-                text_to_sql_prompt=text_to_sql_template,
+                text_to_sql_prompt=_get_text_to_sql_template(),
                 streaming=True,
             )
+            # aquery() executes the generated SQL through this retriever; keep it off the event loop
+            self._query_engine.sql_retriever._sql_retriever = _ThreadedSQLRetriever(self._sql_database)
             logger.info("Initialized NLSQLTableQueryEngine")
 
     def _init_segment_query_engine(self, current_date: str):
@@ -127,17 +224,11 @@ class CRMQueryEngine:
         self._init_sql_database()
         self._init_llm()
 
-        tables = [t.strip() for t in self.settings.db_tables.split(",")]
-
-        # Create prompt with current_date injected
-        segment_prompt = SEGMENT_SQL_ONLY_PROMPT.replace("{current_date}", current_date)
-        text_to_sql_template = PromptTemplate(segment_prompt)
-
         self._segment_query_engine = NLSQLTableQueryEngine(
             sql_database=self._sql_database,
-            tables=tables,
+            tables=self._tables,
             llm=self._llm,
-            text_to_sql_prompt=text_to_sql_template,
+            text_to_sql_prompt=_get_segment_sql_template(current_date),
             sql_only=True,
             synthesize_response=False,
         )
@@ -147,6 +238,9 @@ class CRMQueryEngine:
         """
         Execute a natural language query against the CRM database.
 
+        Identical questions that arrive while one is already running share
+        its result instead of issuing another upstream call.
+
         Args:
             question: Natural language question about CRM data
 
@@ -155,11 +249,29 @@ class CRMQueryEngine:
         """
         self._init_query_engine()
 
-        logger.info(f"Processing query: {question}")
+        task = self._inflight_queries.get(question)
+        if task is None:
+            logger.info(f"Processing query: {question}")
+            task = asyncio.create_task(self._run_query(question))
+            self._inflight_queries[question] = task
+            task.add_done_callback(lambda _: self._inflight_queries.pop(question, None))
+        else:
+            logger.info(f"Joining in-flight query: {question}")
 
-        try:
+        # Shield so one cancelled caller does not cancel the shared query
+        return await asyncio.shield(task)
+
+    async def _run_query(self, question: str) -> str:
+        """Run a single query against the engine, bounded by the LLM semaphore."""
+
+        def run_query() -> str:
             response = self._query_engine.query(question)
-            result = response.response if hasattr(response, "response") else str(response)
+            # str() drains a streaming response, so it runs in the worker thread too
+            return response.response if hasattr(response, "response") else str(response)
+
+        try:
+            async with self._llm_slot():
+                result = await asyncio.to_thread(run_query)
             logger.info("Query completed successfully")
             return result
         except Exception as e:
@@ -181,16 +293,25 @@ class CRMQueryEngine:
         logger.info(f"Processing streaming query: {question}")
 
         try:
-            response = self._query_engine.query(question)
-
-            # Check if response supports streaming
-            if hasattr(response, "response_gen"):
-                for chunk in response.response_gen:
+            # Hold the LLM slot until the first token only, so a client slow to
+            # read the stream does not keep other LLM calls waiting
+            async with self._llm_slot():
+                response = await self._query_engine.aquery(question)
+
+                # Check if response supports async streaming
+                if hasattr(response, "async_response_gen"):
+                    chunks = response.async_response_gen()
+                    first_chunk = await anext(chunks, None)
+                else:
+                    # Fallback to non-streaming
+                    chunks = None
+                    first_chunk = response.response if hasattr(response, "response") else str(response)
+
+            if first_chunk is not None:
+                yield first_chunk
+            if chunks is not None:
+                async for chunk in chunks:
                     yield chunk
-            else:
-                # Fallback to non-streaming
-                result = response.response if hasattr(response, "response") else str(response)
-                yield result
 
             logger.info("Streaming query completed successfully")
         except Exception as e:
@@ -215,49 +336,54 @@ class CRMQueryEngine:
         prompt = SEGMENT_GENERATION_PROMPT.format(description=description)
 
         try:
-            response = self._llm.complete(prompt)
+            async with self._llm_slot():
+                response = await asyncio.to_thread(self._llm.complete, prompt)
             result_text = response.text.strip()
 
-            # Parse JSON response
-            import json
-
-            # Clean up markdown code blocks if present
-            if result_text.startswith("```"):
-                result_text = result_text.split("```")[1]
-                if result_text.startswith("json"):
-                    result_text = result_text[4:]
-                result_text = result_text.strip()
-
-            result = json.loads(result_text)
+            # Strip markdown code fences and parse; large payloads go to a worker thread
+            if len(result_text) > _OFFLOAD_PARSE_THRESHOLD:
+                result = await asyncio.to_thread(_parse_fenced_json, result_text)
+            else:
+                result = _parse_fenced_json(result_text)
             logger.info(f"Generated segment: {result.get('name')}")
             return result
-        except json.JSONDecodeError as e:
+        except orjson.JSONDecodeError as e:
             logger.error(f"Failed to parse segment response: {e}")
             raise ValueError(f"Invalid segment response format: {result_text}")
         except Exception as e:
             logger.error(f"Segment generation error: {e}")
             raise
 
-    async def execute_segment_sql(self, sql: str) -> list[dict]:
+    async def stream_segment_sql(self, sql: str, batch_size: int = 500) -> AsyncIterator[list[dict]]:
         """
-        Execute a segment SQL query and return results.
+        Execute a segment SQL query and stream results in batches.
+
+        Uses a server-side cursor so at most one batch is held in memory.
 
         Args:
             sql: SQL query to execute
+            batch_size: Number of rows fetched from MySQL per batch
 
-        Returns:
-            List of customer records
+        Yields:
+            Batches of customer records
         """
-        self._init_engine()
+        self._init_async_engine()
 
-        logger.info(f"Executing segment SQL: {sql[:100]}...")
+        logger.info(f"Streaming segment SQL: {sql[:100]}...")
 
         try:
-            with self._engine.connect() as conn:
-                result = conn.execute(text(sql))
-                rows = [dict(row._mapping) for row in result]
-                logger.info(f"Segment query returned {len(rows)} rows")
-                return rows
+            async with self._async_engine.connect() as conn:
+                async with conn.stream(
+                    text(sql), execution_options={"yield_per": batch_size}
+                ) as result:
+                    keys = tuple(result.keys())
+                    count = 0
+                    # Result.yield_per is not applied to text() statements, so the
+                    # partition size must be passed explicitly
+                    async for partition in result.partitions(batch_size):
+                        count += len(partition)
+                        yield [dict(zip(keys, row)) for row in partition]
+                    logger.info(f"Segment query streamed {count} rows")
         except Exception as e:
             logger.error(f"Segment SQL execution error: {e}")
             raise
@@ -291,7 +417,8 @@ class CRMQueryEngine:
         segment_query = f"Find customers that match: {description}. Return custid, custcode, custname, custemail, mobileno from customer table."
 
         try:
-            response = self._segment_query_engine.query(segment_query)
+            async with self._llm_slot():
+                response = await asyncio.to_thread(self._segment_query_engine.query, segment_query)
 
             # Extract SQL from response
             raw_sql = str(response)
@@ -323,7 +450,8 @@ class CRMQueryEngine:
             )
 
             try:
-                metadata_response = self._llm.complete(metadata_prompt)
+                async with self._llm_slot():
+                    metadata_response = await asyncio.to_thread(self._llm.complete, metadata_prompt)
                 metadata_text = metadata_response.text.strip()
 
                 # Clean up markdown if present
@@ -367,7 +495,7 @@ class CRMQueryEngine:
                 "viewName": view_name
             }
 
-        except (ValueError, RuntimeError):
+        except (ValueError, RuntimeError, LLMBusyError):
             raise
         except Exception as e:
             logger.error(f"Segment view creation error: {e}")
@@ -409,7 +537,8 @@ class CRMQueryEngine:
 
             with self._engine.connect() as conn:
                 result = conn.execute(text(sql))
-                rows = [dict(row._mapping) for row in result]
+                keys = tuple(result.keys())
+                rows = [dict(zip(keys, row)) for row in result.fetchall()]
                 logger.info(f"View query returned {len(rows)} rows")
                 return rows
         except Exception as e:
@@ -504,7 +633,8 @@ class CRMQueryEngine:
         prompt = CUSTOMER_PERSONALITY_PROMPT.format(customer_data=formatted_data)
 
         try:
-            response = self._llm.complete(prompt)
+            async with self._llm_slot():
+                response = await asyncio.to_thread(self._llm.complete, prompt)
             result_text = response.text.strip()
 
             # Clean up markdown code blocks if present
@@ -556,11 +686,13 @@ class CRMQueryEngine:
 
             client = OpenAIClient(api_key=self.settings.openai_api_key)
 
-            response = client.chat.completions.create(
-                model=self.settings.openai_model,
-                messages=messages,
-                temperature=0.7,
-            )
+            async with self._llm_slot():
+                response = await asyncio.to_thread(
+                    client.chat.completions.create,
+                    model=self.settings.openai_model,
+                    messages=messages,
+                    temperature=0.7,
+                )
 
             result = response.choices[0].message.content
             logger.info("Contextual chat completed successfully")
@@ -589,16 +721,21 @@ class CRMQueryEngine:
 
             client = AsyncOpenAI(api_key=self.settings.openai_api_key)
 
-            stream = await client.chat.completions.create(
-                model=self.settings.openai_model,
-                messages=messages,
-                temperature=0.7,
-                stream=True,
-            )
-
-            async for chunk in stream:
-                if chunk.choices[0].delta.content:
-                    yield chunk.choices[0].delta.content
+            # Hold the LLM slot until the first chunk only, so a client slow to
+            # read the stream does not keep other LLM calls waiting
+            async with self._llm_slot():
+                stream = await client.chat.completions.create(
+                    model=self.settings.openai_model,
+                    messages=messages,
+                    temperature=0.7,
+                    stream=True,
+                )
+                first_chunk = await anext(stream, None)
+
+            if first_chunk is not None:
+                async for chunk in _prepend(first_chunk, stream):
+                    if chunk.choices[0].delta.content:
+                        yield chunk.choices[0].delta.content
 
             logger.info("Streaming contextual chat completed successfully")
 
@@ -606,25 +743,46 @@ class CRMQueryEngine:
             logger.error(f"Streaming contextual chat error: {e}")
             raise
 
+    async def warm_up(self) -> None:
+        """Build the engines, schema reflection and query engine before the first request."""
+
+        def init_sql_database() -> None:
+            self._init_sql_database()
+            # SQLDatabase reflects through its own Inspector; fill the cache of the one
+            # get_single_table_info uses so the first query skips per-table reflection
+            for table in self._tables:
+                self._sql_database.get_single_table_info(table)
+
+        # Engine creation does no I/O; build it first so the concurrent steps share it
+        self._init_engine()
+        await asyncio.gather(
+            asyncio.to_thread(init_sql_database),
+            asyncio.to_thread(self._init_llm),
+            asyncio.to_thread(self.health_check),
+        )
+        self._init_query_engine()
+        logger.info("CRM query engine warmed up")
+
+    async def aclose(self) -> None:
+        """Dispose pooled database connections."""
+        if self._async_engine is not None:
+            await self._async_engine.dispose()
+        if self._engine is not None:
+            self._engine.dispose()
+
     def health_check(self) -> bool:
         """Check database connectivity."""
         try:
             self._init_engine()
             with self._engine.connect() as conn:
-                conn.execute(text("SELECT 1"))
+                conn.scalar(_HEALTH_STMT)
             return True
         except Exception as e:
             logger.error(f"Health check failed: {e}")
             return False
 
 
-# Singleton instance
-_engine_instance: Optional[CRMQueryEngine] = None
-
-
+@lru_cache
 def get_crm_engine() -> CRMQueryEngine:
-    """Get or create the CRM query engine singleton."""
-    global _engine_instance
-    if _engine_instance is None:
-        _engine_instance = CRMQueryEngine()
-    return _engine_instance
+    """Get cached per-process CRM query engine instance."""
+    return CRMQueryEngine()
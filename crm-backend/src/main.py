@@ -1,19 +1,21 @@
 """FastAPI application with OpenAI-compatible chat completions endpoint."""
 
-import json
 import logging
 import time
 import uuid
+from contextlib import aclosing, asynccontextmanager
+from datetime import timedelta
+from decimal import Decimal
 from typing import AsyncGenerator, Optional
 
-from fastapi import FastAPI, HTTPException, Request
+import orjson
+from fastapi import Depends, FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from pydantic import BaseModel, Field
-from sse_starlette.sse import EventSourceResponse
 
 from .config import get_settings
-from .engine import get_crm_engine
+from .engine import CRMQueryEngine, LLMBusyError, get_crm_engine
 
 # Configure logging
 logging.basicConfig(
@@ -22,10 +24,34 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+
+async def get_engine() -> CRMQueryEngine:
+    """Resolve the per-process CRM engine; override in tests via app.dependency_overrides."""
+    return get_crm_engine()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Warm up the query engine before serving requests and dispose its pools on shutdown."""
+    engine = get_crm_engine()
+    try:
+        await engine.warm_up()
+    except Exception as e:
+        # Keep serving; endpoints retry initialization lazily
+        logger.warning(f"CRM query engine warm-up failed: {e}")
+
+    yield
+
+    # Release pooled MySQL connections while the event loop is still running
+    await engine.aclose()
+
+
 app = FastAPI(
     title="CRM Query Backend",
     description="OpenAI-compatible API for CRM database queries using LlamaIndex",
     version="0.1.0",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse,
 )
 
 # CORS middleware
@@ -191,9 +217,8 @@ class CustomerPersonalityResponse(BaseModel):
 
 
 @app.get("/health")
-async def health_check():
+async def health_check(engine: CRMQueryEngine = Depends(get_engine)):
     """Health check endpoint."""
-    engine = get_crm_engine()
     db_healthy = engine.health_check()
     return {
         "status": "healthy" if db_healthy else "unhealthy",
@@ -201,27 +226,48 @@ async def health_check():
     }
 
 
-@app.get("/v1/models")
-async def list_models() -> ModelsResponse:
+@app.get("/v1/models", response_model=None, responses={200: {"model": ModelsResponse}})
+async def list_models():
     """List available models (OpenAI-compatible)."""
-    return ModelsResponse(
-        data=[
-            ModelInfo(
-                id="crm-sql-engine",
-                created=int(time.time()),
-                owned_by="crm-backend",
-            ),
-            ModelInfo(
-                id="crm-chat-assistant",
-                created=int(time.time()),
-                owned_by="crm-backend",
-            ),
-        ]
-    )
+    created = int(time.time())
+    return {
+        "object": "list",
+        "data": [
+            {
+                "id": "crm-sql-engine",
+                "object": "model",
+                "created": created,
+                "owned_by": "crm-backend",
+            },
+            {
+                "id": "crm-chat-assistant",
+                "object": "model",
+                "created": created,
+                "owned_by": "crm-backend",
+            },
+        ],
+    }
+
+
+# Headers EventSourceResponse used to set; keep proxies from caching or buffering the stream
+_SSE_HEADERS = {"Cache-Control": "no-store", "X-Accel-Buffering": "no"}
+
+
+async def sse_formatter(payloads: AsyncGenerator[bytes, None]) -> AsyncGenerator[bytes, None]:
+    """Frame pre-encoded payloads as SSE "data:" events."""
+    async for payload in payloads:
+        yield b"data: " + payload + b"\n\n"
+
+
+# Token chunks are coalesced before framing: the batch starts at one chunk so
+# time-to-first-token is unchanged, then grows geometrically up to the cap.
+_STREAM_MAX_BATCH_SIZE = 50
+_STREAM_BATCH_GROWTH = 3
+_STREAM_FLUSH_INTERVAL = 0.02
 
 
 @app.post("/v1/chat/completions", response_model=None)
-async def chat_completions(request: ChatCompletionRequest):
+async def chat_completions(request: ChatCompletionRequest, engine: CRMQueryEngine = Depends(get_engine)):
     """
     OpenAI-compatible chat completions endpoint.
 
@@ -229,7 +275,6 @@ async def chat_completions(request: ChatCompletionRequest):
     - crm-sql-engine: Processes natural language queries about CRM data using SQL
     - crm-chat-assistant: Contextual chat using full message history (for customer pages)
     """
-    engine = get_crm_engine()
     request_id = f"chatcmpl-{uuid.uuid4().hex[:12]}"
     created = int(time.time())
 
@@ -242,14 +287,17 @@ async def chat_completions(request: ChatCompletionRequest):
         messages = [{"role": m.role, "content": m.content} for m in request.messages]
 
         if request.stream:
-            return EventSourceResponse(
-                stream_contextual_response(engine, messages, request_id, created, request.model),
+            return StreamingResponse(
+                sse_formatter(stream_contextual_response(engine, messages, request_id, created, request.model)),
                 media_type="text/event-stream",
+                headers=_SSE_HEADERS,
             )
 
         # Non-streaming contextual response
         try:
             response_text = await engine.chat_with_context(messages)
+            prompt_tokens = sum(len(m.content.split()) for m in request.messages)
+            completion_tokens = len(response_text.split())
 
             return ChatCompletionResponse(
                 id=request_id,
@@ -263,11 +311,13 @@ async def chat_completions(request: ChatCompletionRequest):
                     )
                 ],
                 usage=ChatCompletionUsage(
-                    prompt_tokens=sum(len(m.content.split()) for m in request.messages),
-                    completion_tokens=len(response_text.split()),
-                    total_tokens=sum(len(m.content.split()) for m in request.messages) + len(response_text.split()),
+                    prompt_tokens=prompt_tokens,
+                    completion_tokens=completion_tokens,
+                    total_tokens=prompt_tokens + completion_tokens,
                 ),
             )
+        except LLMBusyError as e:
+            raise HTTPException(status_code=503, detail=str(e))
         except Exception as e:
             logger.error(f"Contextual chat error: {e}")
             raise HTTPException(status_code=500, detail=str(e))
@@ -282,14 +332,17 @@ async def chat_completions(request: ChatCompletionRequest):
         logger.info(f"Received SQL query: {query}")
 
         if request.stream:
-            return EventSourceResponse(
-                stream_response(engine, query, request_id, created, request.model),
+            return StreamingResponse(
+                sse_formatter(stream_response(engine, query, request_id, created, request.model)),
                 media_type="text/event-stream",
+                headers=_SSE_HEADERS,
             )
 
         # Non-streaming SQL response
         try:
             response_text = await engine.query(query)
+            prompt_tokens = len(query.split())
+            completion_tokens = len(response_text.split())
 
             return ChatCompletionResponse(
                 id=request_id,
@@ -303,11 +356,13 @@ async def chat_completions(request: ChatCompletionRequest):
                     )
                 ],
                 usage=ChatCompletionUsage(
-                    prompt_tokens=len(query.split()),
-                    completion_tokens=len(response_text.split()),
-                    total_tokens=len(query.split()) + len(response_text.split()),
+                    prompt_tokens=prompt_tokens,
+                    completion_tokens=completion_tokens,
+                    total_tokens=prompt_tokens + completion_tokens,
                 ),
             )
+        except LLMBusyError as e:
+            raise HTTPException(status_code=503, detail=str(e))
         except Exception as e:
             logger.error(f"SQL query error: {e}")
             raise HTTPException(status_code=500, detail=str(e))
@@ -315,25 +370,41 @@ async def chat_completions(request: ChatCompletionRequest):
 
 async def stream_response(
     engine, query: str, request_id: str, created: int, model: str
-) -> AsyncGenerator[str, None]:
+) -> AsyncGenerator[bytes, None]:
     """Generate streaming SSE response in OpenAI format for SQL queries."""
+
+    def content_chunk(content: str) -> bytes:
+        data = {
+            "id": request_id,
+            "object": "chat.completion.chunk",
+            "created": created,
+            "model": model,
+            "choices": [
+                {
+                    "index": 0,
+                    "delta": {"content": content},
+                    "finish_reason": None,
+                }
+            ],
+        }
+        return orjson.dumps(data)
+
     try:
+        buffer: list[str] = []
+        batch_size = 1
+        last_flush = time.monotonic()
+
         async for chunk in engine.query_streaming(query):
-            data = {
-                "id": request_id,
-                "object": "chat.completion.chunk",
-                "created": created,
-                "model": model,
-                "choices": [
-                    {
-                        "index": 0,
-                        "delta": {"content": chunk},
-                        "finish_reason": None,
-                    }
-                ],
-            }
-            # EventSourceResponse adds "data: " prefix automatically
-            yield json.dumps(data)
+            buffer.append(chunk)
+            now = time.monotonic()
+            if len(buffer) >= batch_size or now - last_flush > _STREAM_FLUSH_INTERVAL:
+                yield content_chunk("".join(buffer))
+                buffer.clear()
+                batch_size = min(batch_size * _STREAM_BATCH_GROWTH, _STREAM_MAX_BATCH_SIZE)
+                last_flush = now
+
+        if buffer:
+            yield content_chunk("".join(buffer))
 
         # Send final chunk with finish_reason
         final_data = {
@@ -349,18 +420,18 @@ async def stream_response(
                 }
             ],
         }
-        yield json.dumps(final_data)
-        yield "[DONE]"
+        yield orjson.dumps(final_data)
+        yield b"[DONE]"
 
     except Exception as e:
         logger.error(f"Streaming error: {e}")
         error_data = {"error": str(e)}
-        yield json.dumps(error_data)
+        yield orjson.dumps(error_data)
 
 
 async def stream_contextual_response(
     engine, messages: list[dict], request_id: str, created: int, model: str
-) -> AsyncGenerator[str, None]:
+) -> AsyncGenerator[bytes, None]:
     """Generate streaming SSE response in OpenAI format for contextual chat."""
     try:
         async for chunk in engine.chat_with_context_streaming(messages):
@@ -377,7 +448,7 @@ async def stream_contextual_response(
                     }
                 ],
             }
-            yield json.dumps(data)
+            yield orjson.dumps(data)
 
         # Send final chunk with finish_reason
         final_data = {
@@ -393,13 +464,13 @@ async def stream_contextual_response(
                 }
             ],
         }
-        yield json.dumps(final_data)
-        yield "[DONE]"
+        yield orjson.dumps(final_data)
+        yield b"[DONE]"
 
     except Exception as e:
         logger.error(f"Contextual streaming error: {e}")
         error_data = {"error": str(e)}
-        yield json.dumps(error_data)
+        yield orjson.dumps(error_data)
 
 
 # ============================================================================
@@ -407,14 +478,14 @@ async def stream_contextual_response(
 # ============================================================================
 
 
-@app.post("/api/segments/generate", response_model=SegmentGenerateResponse)
-async def generate_segment(request: SegmentGenerateRequest):
+@app.post("/api/segments/generate", response_model=None, responses={200: {"model": SegmentGenerateResponse}})
+async def generate_segment(request: SegmentGenerateRequest, engine: CRMQueryEngine = Depends(get_engine)):
     """Generate a customer segment SQL from natural language description."""
-    engine = get_crm_engine()
-
     try:
         result = await engine.generate_segment(request.description)
-        return SegmentGenerateResponse(name=result["name"], sql=result["sql"])
+        return ORJSONResponse(content={"name": result["name"], "sql": result["sql"]})
+    except LLMBusyError as e:
+        raise HTTPException(status_code=503, detail=str(e))
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
@@ -422,24 +493,53 @@ async def generate_segment(request: SegmentGenerateRequest):
         raise HTTPException(status_code=500, detail=str(e))
 
 
+def _json_default(value):
+    """Serialize MySQL column types that orjson does not handle natively."""
+    if isinstance(value, Decimal):
+        # Same rule as FastAPI's decimal_encoder, so execute-view and execute agree
+        return int(value) if value.as_tuple().exponent >= 0 else float(value)
+    if isinstance(value, timedelta):
+        return value.total_seconds()
+    if isinstance(value, bytes):
+        return value.decode()
+    raise TypeError
+
+
 @app.post("/api/segments/execute")
-async def execute_segment(request: SegmentExecuteRequest):
-    """Execute a segment SQL query and return matching customers."""
-    engine = get_crm_engine()
+async def execute_segment(request: SegmentExecuteRequest, engine: CRMQueryEngine = Depends(get_engine)):
+    """Execute a segment SQL query and stream matching customers as NDJSON."""
+    batches = engine.stream_segment_sql(request.sql)
 
+    # Fetch the first batch up front so SQL errors still map to a 500 response
     try:
-        rows = await engine.execute_segment_sql(request.sql)
-        return {"customers": rows, "count": len(rows)}
+        first_batch = await anext(batches, None)
     except Exception as e:
         logger.error(f"Segment execution error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+    def encode(batch: list[dict]) -> bytes:
+        return b"".join(orjson.dumps(row, default=_json_default) + b"\n" for row in batch)
+
+    async def ndjson() -> AsyncGenerator[bytes, None]:
+        # Close the generator (and release its connection) even if the client disconnects
+        async with aclosing(batches):
+            if first_batch is None:
+                return
+            yield encode(first_batch)
+            try:
+                async for batch in batches:
+                    yield encode(batch)
+            except Exception as e:
+                # Headers are already sent; end with an error record so the result is not silently truncated
+                logger.error(f"Segment streaming error: {e}")
+                yield orjson.dumps({"error": str(e)}) + b"\n"
+
+    return StreamingResponse(ndjson(), media_type="application/x-ndjson")
+
 
 @app.post("/api/segments/create")
-async def create_segment(request: SegmentCreateRequest):
+async def create_segment(request: SegmentCreateRequest, engine: CRMQueryEngine = Depends(get_engine)):
     """Create segment VIEW from description."""
-    engine = get_crm_engine()
-
     try:
         result = await engine.create_segment_view(
             request.segmentId,
@@ -447,6 +547,8 @@ async def create_segment(request: SegmentCreateRequest):
             request.currentDate
         )
         return result
+    except LLMBusyError as e:
+        raise HTTPException(status_code=503, detail=str(e))
     except ValueError as e:
         logger.error(f"Segment creation validation error: {e}")
         raise HTTPException(status_code=400, detail=str(e))
@@ -459,10 +561,12 @@ async def create_segment(request: SegmentCreateRequest):
 
 
 @app.post("/api/segments/{segment_id}/refresh")
-async def refresh_segment(segment_id: str, request: SegmentRefreshRequest):
+async def refresh_segment(
+    segment_id: str,
+    request: SegmentRefreshRequest,
+    engine: CRMQueryEngine = Depends(get_engine),
+):
     """Refresh existing segment VIEW with new dates."""
-    engine = get_crm_engine()
-
     try:
         result = await engine.refresh_segment_view(
             segment_id,
@@ -470,6 +574,8 @@ async def refresh_segment(segment_id: str, request: SegmentRefreshRequest):
             request.currentDate
         )
         return result
+    except LLMBusyError as e:
+        raise HTTPException(status_code=503, detail=str(e))
     except ValueError as e:
         logger.error(f"Segment refresh validation error: {e}")
         raise HTTPException(status_code=400, detail=str(e))
@@ -482,10 +588,11 @@ async def refresh_segment(segment_id: str, request: SegmentRefreshRequest):
 
 
 @app.post("/api/segments/execute-view")
-async def execute_segment_view(request: SegmentExecuteViewRequest):
+async def execute_segment_view(
+    request: SegmentExecuteViewRequest,
+    engine: CRMQueryEngine = Depends(get_engine),
+):
     """Execute SELECT from VIEW."""
-    engine = get_crm_engine()
-
     try:
         rows = await engine.execute_view(request.viewName)
         return {"customers": rows, "count": len(rows)}
@@ -503,15 +610,13 @@ async def execute_segment_view(request: SegmentExecuteViewRequest):
 
 
 @app.get("/api/customer/{customer_id}")
-async def get_customer(customer_id: int):
+async def get_customer(customer_id: int, engine: CRMQueryEngine = Depends(get_engine)):
     """
     Fetch customer data from MySQL by custid.
 
     Returns all customer fields as JSON, including related data
     from customertype, customertypedtl, city, and branch tables.
     """
-    engine = get_crm_engine()
-
     try:
         customer = await engine.get_customer_by_id(customer_id)
 
@@ -534,15 +639,17 @@ async def get_customer(customer_id: int):
 
 
 @app.post("/api/customer/{customer_id}/personality", response_model=CustomerPersonalityResponse)
-async def generate_customer_personality(customer_id: int, request: CustomerPersonalityRequest):
+async def generate_customer_personality(
+    customer_id: int,
+    request: CustomerPersonalityRequest,
+    engine: CRMQueryEngine = Depends(get_engine),
+):
     """
     Generate personality analysis for a customer using LLM.
 
     Takes customer data as input and returns a summary and preferences
     in Indonesian language.
     """
-    engine = get_crm_engine()
-
     try:
         # Convert request to dict, excluding None values
         customer_data = request.model_dump(exclude_none=True)
@@ -557,6 +664,8 @@ async def generate_customer_personality(customer_id: int, request: CustomerPerso
             preferences=result["preferences"]
         )
 
+    except LLMBusyError as e:
+        raise HTTPException(status_code=503, detail=str(e))
     except ValueError as e:
         logger.error(f"Customer personality validation error: {e}")
         raise HTTPException(status_code=400, detail=str(e))